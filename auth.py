@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from dataclasses import dataclass
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
@@ -6,7 +7,7 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from database import get_db
-from models import User
+from models import User, UserRole
 import os
 
 # Configurações de segurança
@@ -51,36 +52,101 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """Obter usuário atual do token JWT"""
-    credentials_exception = HTTPException(
+@dataclass
+class TokenUser:
+    """Usuário reconstruído a partir das claims do JWT (sem consulta ao banco)"""
+    id: int
+    email: str
+    is_admin: bool
+    role: Optional[str]
+
+def token_user_from_claims(payload: dict) -> Optional[TokenUser]:
+    """Montar TokenUser a partir das claims; None quando o token não traz id e status ativo"""
+    if payload.get("uid") is None or not payload.get("active"):
+        return None
+    return TokenUser(
+        id=payload["uid"],
+        email=payload["sub"],
+        is_admin=bool(payload.get("is_admin")),
+        role=payload.get("role")
+    )
+
+def create_user_token(user: User) -> str:
+    """Criar token JWT com as claims usadas pelos endpoints de leitura"""
+    role = user.role.value if user.role is not None else None
+    return create_access_token(data={
+        "sub": user.email,
+        "uid": user.id,
+        "is_admin": user.is_admin,
+        "role": role,
+        "active": user.is_active
+    })
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    
+
+def _decode_token(credentials: HTTPAuthorizationCredentials) -> dict:
+    """Decodificar token JWT e validar a claim sub"""
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
-        raise credentials_exception
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
+
+def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    """Obter usuário atual do token JWT"""
+    payload = _decode_token(credentials)
     
-    user = db.query(User).filter(User.email == email, User.is_active == True).first()
+    user = db.query(User).filter(User.email == payload["sub"], User.is_active == True).first()
     if user is None:
-        raise credentials_exception
+        raise _credentials_exception()
     return user
 
-async def get_current_admin_user(current_user: User = Depends(get_current_user)) -> User:
+def get_current_user_lite(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> TokenUser:
+    """Obter usuário atual apenas pelas claims do JWT (endpoints de leitura)"""
+    payload = _decode_token(credentials)
+    
+    token_user = token_user_from_claims(payload)
+    if token_user is not None:
+        return token_user
+    
+    # Tokens emitidos antes das claims extras: buscar no banco
+    user = db.query(User).filter(User.email == payload["sub"], User.is_active == True).first()
+    if user is None:
+        raise _credentials_exception()
+    return TokenUser(
+        id=user.id,
+        email=user.email,
+        is_admin=user.is_admin,
+        role=user.role.value if user.role is not None else None
+    )
+
+def get_current_admin_user(current_user: User = Depends(get_current_user)) -> User:
     """Verificar se o usuário atual é administrador"""
     if not current_user.is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Acesso restrito a administradores"
         )
-    return current_user
\ No newline at end of file
+    return current_user
+
+def get_current_admin_or_broker_user(current_user: User = Depends(get_current_user)) -> User:
+    """Verificar se o usuário atual é administrador ou corretor"""
+    if not (current_user.is_admin or current_user.role == UserRole.BROKER):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Acesso não autorizado"
+        )
+    return current_user
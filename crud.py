@@ -1,7 +1,8 @@
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func, and_, or_, desc, asc
+from sqlalchemy.orm import Session, joinedload, raiseload
+from sqlalchemy import func, and_, or_, desc, asc, select
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
+from itertools import islice
 import pandas as pd
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
@@ -10,9 +11,12 @@ from reportlab.lib import colors
 from reportlab.lib.units import inch
 from reportlab.pdfgen import canvas
 import os
+import time
+import threading
+from collections import OrderedDict
 
 # Importações locais
-from models import User, Lead, Broker, LeadDistribution, LeadStatus, LeadStatusEnum, WhatsAppConnection, WhatsAppConversation, WhatsAppMessage
+from models import User, Lead, Broker, LeadDistribution, LeadStatus, LeadStatusEnum, LEAD_STATUS_BY_VALUE, WhatsAppConnection, WhatsAppConversation, WhatsAppMessage
 from schemas import (
     UserCreate, LeadCreate, LeadUpdate, BrokerCreate, BrokerUpdate,
     LeadFilters, DashboardStats
@@ -57,19 +61,17 @@ def create_lead(db: Session, lead: LeadCreate) -> Lead:
     db.refresh(db_lead)
     return db_lead
 
-def get_leads(db: Session, filters: LeadFilters, skip: int = 0, limit: int = 100) -> List[Lead]:
-    """Buscar leads com filtros"""
-    query = db.query(Lead).options(joinedload(Lead.assigned_broker))
+def _filtered_leads_query(db: Session, filters: LeadFilters):
+    """Query de leads com filtros aplicados, ordenada do mais recente para o mais antigo"""
+    # raiseload: relacionamento não carregado aqui gera erro em vez de N+1 silencioso
+    query = db.query(Lead).options(joinedload(Lead.assigned_broker), raiseload("*"))
     
     # Aplicar filtros
     if filters.status:
-        try:
-            # Converter string para enum se necessário
-            status_enum = LeadStatusEnum(filters.status) if isinstance(filters.status, str) else filters.status
+        # Converter string para enum; status inválido é ignorado
+        status_enum = LEAD_STATUS_BY_VALUE.get(filters.status) if isinstance(filters.status, str) else filters.status
+        if status_enum is not None:
             query = query.filter(Lead.status == status_enum)
-        except ValueError:
-            # Se o status não for válido, ignorar filtro
-            pass
     
     if filters.broker_id:
         query = query.filter(Lead.assigned_broker_id == filters.broker_id)
@@ -78,20 +80,27 @@ def get_leads(db: Session, filters: LeadFilters, skip: int = 0, limit: int = 100
         query = query.filter(Lead.source == filters.source)
     
     if filters.date_from:
-        try:
-            date_from = datetime.fromisoformat(filters.date_from)
-            query = query.filter(Lead.created_at >= date_from)
-        except ValueError:
-            pass
+        query = query.filter(Lead.created_at >= filters.date_from)
     
     if filters.date_to:
-        try:
-            date_to = datetime.fromisoformat(filters.date_to)
-            query = query.filter(Lead.created_at <= date_to)
-        except ValueError:
-            pass
+        query = query.filter(Lead.created_at <= filters.date_to)
     
-    return query.order_by(desc(Lead.created_at)).offset(skip).limit(limit).all()
+    return query.order_by(desc(Lead.created_at))
+
+def get_leads(db: Session, filters: LeadFilters, skip: int = 0, limit: int = 100) -> List[Lead]:
+    """Buscar leads com filtros"""
+    return _filtered_leads_query(db, filters).offset(skip).limit(limit).all()
+
+def iter_leads_in_chunks(
+    db: Session, filters: LeadFilters, skip: int = 0, limit: int = 100, chunk_size: int = 500
+) -> Iterator[List[Lead]]:
+    """Buscar leads com filtros em blocos (yield_per), sem materializar o resultado inteiro"""
+    rows = iter(_filtered_leads_query(db, filters).offset(skip).limit(limit).yield_per(chunk_size))
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
 
 def get_lead_by_id(db: Session, lead_id: int) -> Optional[Lead]:
     """Buscar lead por ID"""
@@ -133,7 +142,7 @@ def delete_lead(db: Session, lead_id: int) -> bool:
 def get_brokers(db: Session, skip: int = 0, limit: int = 100) -> List[Broker]:
     """Buscar corretores"""
     return (db.query(Broker)
-            .options(joinedload(Broker.user))
+            .options(joinedload(Broker.user), raiseload("*"))
             .filter(Broker.is_active == True)
             .order_by(asc(Broker.distribution_order))
             .offset(skip)
@@ -179,56 +188,199 @@ def delete_broker(db: Session, broker_id: int) -> bool:
     return True
 
 # Distribuição de leads
+def _select_next_broker(db: Session) -> Optional[Broker]:
+    """Selecionar e travar o próximo corretor ativo abaixo do limite diário"""
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    
+    # Leads distribuídos hoje para o corretor (subconsulta correlacionada)
+    leads_today = (select(func.count(LeadDistribution.id))
+                   .where(
+                       LeadDistribution.broker_id == Broker.user_id,
+                       LeadDistribution.distributed_at >= today
+                   )
+                   .scalar_subquery())
+    
+    eligible = (Broker.is_active == True, leads_today < Broker.max_leads_per_day)
+    query = (db.query(Broker)
+             .options(joinedload(Broker.user, innerjoin=True))
+             .filter(*eligible)
+             .order_by(asc(Broker.distribution_order)))
+    
+    # SKIP LOCKED evita que leads concorrentes disputem o mesmo corretor
+    broker = query.with_for_update(skip_locked=True, of=Broker).first()
+    if broker is not None:
+        return broker
+    
+    # Só aguardar a trava se existir corretor elegível (todos travados por outras transações)
+    if db.query(Broker.id).filter(*eligible).first() is None:
+        return None
+    
+    rejected = []
+    while True:
+        broker = (query.filter(Broker.id.notin_(rejected))
+                  .populate_existing()
+                  .with_for_update(of=Broker)
+                  .first())
+        if broker is None:
+            return None
+        
+        # Revalidar o limite: outra transação pode ter distribuído leads enquanto aguardávamos
+        distributed_today = db.scalar(
+            select(func.count(LeadDistribution.id))
+            .where(
+                LeadDistribution.broker_id == broker.user_id,
+                LeadDistribution.distributed_at >= today
+            )
+        )
+        if distributed_today < broker.max_leads_per_day:
+            return broker
+        rejected.append(broker.id)
+
+def _assign_lead(db: Session, lead: Lead, broker: Broker):
+    """Atribuir lead ao corretor e registrar histórico (sem commit)"""
+    lead.assigned_broker_id = broker.user_id
+    lead.assigned_at = datetime.utcnow()
+    
+    db.add(LeadDistribution(
+        lead_id=lead.id,
+        broker_id=broker.user_id,
+        distribution_method="automatic"
+    ))
+
 def distribute_lead(db: Session, lead_id: int) -> Optional[User]:
     """Distribuir lead para o próximo corretor na ordem"""
-    # Buscar próximo corretor ativo na ordem de distribuição
-    brokers = (db.query(Broker)
-               .options(joinedload(Broker.user))
-               .filter(Broker.is_active == True)
-               .order_by(asc(Broker.distribution_order))
-               .all())
-    
-    if not brokers:
+    lead = db.query(Lead).filter(Lead.id == lead_id).first()
+    if not lead:
         return None
     
-    # Verificar quantos leads cada corretor recebeu hoje
-    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    broker = _select_next_broker(db)
+    if not broker:
+        return None
     
-    for broker in brokers:
-        # Contar leads distribuídos hoje para este corretor
-        leads_today = (db.query(LeadDistribution)
-                      .filter(
-                          LeadDistribution.broker_id == broker.user_id,
-                          LeadDistribution.distributed_at >= today
-                      )
-                      .count())
+    _assign_lead(db, lead, broker)
+    db.commit()
+    return broker.user
+
+def _stage_lead(db: Session, lead: LeadCreate) -> Tuple[Lead, Optional[Broker]]:
+    """Inserir lead e atribuí-lo ao próximo corretor na transação atual (sem commit)"""
+    db_lead = Lead(
+        contact_name=lead.contact_name,
+        phone=lead.phone,
+        initial_message=lead.initial_message,
+        source=lead.source,
+        notes=lead.notes
+    )
+    db.add(db_lead)
+    db.flush()
+    
+    broker = _select_next_broker(db)
+    if broker:
+        _assign_lead(db, db_lead, broker)
+    return db_lead, broker
+
+def create_and_distribute_lead(db: Session, lead: LeadCreate) -> Tuple[Lead, Optional[User]]:
+    """Criar lead e distribuí-lo ao próximo corretor em uma única transação"""
+    db_lead, broker = _stage_lead(db, lead)
+    
+    db.commit()
+    db.refresh(db_lead)
+    return db_lead, broker.user if broker else None
+
+# Telefones que geraram lead pelo webhook recentemente: {telefone: visto_em}
+RECENT_LEAD_PHONES_MAX = 50_000
+RECENT_LEAD_WINDOW = timedelta(hours=24)
+_recent_lead_phones: "OrderedDict[str, float]" = OrderedDict()
+_recent_lead_phones_lock = threading.Lock()
+
+def _lead_phone_seen_recently(phone: str) -> bool:
+    """Verificar se o telefone gerou lead dentro da janela (sem consultar o banco)"""
+    with _recent_lead_phones_lock:
+        seen_at = _recent_lead_phones.get(phone)
+        return seen_at is not None and time.monotonic() - seen_at < RECENT_LEAD_WINDOW.total_seconds()
+
+def _remember_lead_phone(phone: str) -> None:
+    """Registrar telefone que acabou de gerar lead"""
+    with _recent_lead_phones_lock:
+        _recent_lead_phones[phone] = time.monotonic()
+        _recent_lead_phones.move_to_end(phone)
+        while len(_recent_lead_phones) > RECENT_LEAD_PHONES_MAX:
+            _recent_lead_phones.popitem(last=False)
+
+def get_recent_lead_by_phone(db: Session, phone: str, since: datetime) -> Optional[Lead]:
+    """Buscar o lead mais recente de um telefone criado a partir de `since`"""
+    return (db.query(Lead)
+            .filter(Lead.phone == phone, Lead.created_at >= since)
+            .order_by(desc(Lead.created_at))
+            .first())
+
+def record_inbound_whatsapp_message(
+    db: Session, phone_id: Optional[str], from_number: str, contact_name: str, message_text: str
+) -> Tuple[Optional[int], Lead, Optional[User]]:
+    """Registrar mensagem recebida via webhook (conversa, mensagem, lead e status) em um único commit
+    
+    Mensagens repetidas do mesmo telefone dentro de RECENT_LEAD_WINDOW reaproveitam o lead
+    existente e não passam pela distribuição; nesse caso nenhum corretor é retornado.
+    """
+    connection_id = get_whatsapp_connection_id_by_phone_id(db, phone_id)
+    now = datetime.now()
+    
+    if connection_id:
+        # Criar ou obter conversa
+        conversation = db.query(WhatsAppConversation).filter(
+            WhatsAppConversation.connection_id == connection_id,
+            WhatsAppConversation.phone_number == from_number
+        ).first()
+        if not conversation:
+            conversation = WhatsAppConversation(
+                connection_id=connection_id,
+                phone_number=from_number,
+                contact_name=contact_name
+            )
+            db.add(conversation)
+        
+        # Salvar mensagem recebida e atualizar última mensagem da conversa
+        db.add(WhatsAppMessage(
+            conversation=conversation,
+            content=message_text,
+            sent_by_me=False,
+            timestamp=now
+        ))
+        conversation.last_message = message_text
+        conversation.last_message_time = now
         
-        # Verificar se não excedeu o limite diário
-        if leads_today < broker.max_leads_per_day:
-            # Atribuir lead ao corretor
-            lead = db.query(Lead).filter(Lead.id == lead_id).first()
-            if lead:
-                lead.assigned_broker_id = broker.user_id
-                lead.assigned_at = datetime.utcnow()
-                
-                # Registrar histórico de distribuição
-                distribution = LeadDistribution(
-                    lead_id=lead_id,
-                    broker_id=broker.user_id,
-                    distribution_method="automatic"
-                )
-                
-                db.add(distribution)
-                db.commit()
-                
-                return broker.user
-    
-    return None
+        # Mensagem recebida confirma que a conexão está ativa
+        db.query(WhatsAppConnection).filter(WhatsAppConnection.id == connection_id).update(
+            {"status": "connected", "last_seen": now}, synchronize_session=False
+        )
+    
+    # Só consulta lead existente se o telefone gerou lead recentemente neste processo
+    db_lead, broker = None, None
+    if _lead_phone_seen_recently(from_number):
+        db_lead = get_recent_lead_by_phone(db, from_number, now - RECENT_LEAD_WINDOW)
+    
+    is_new_lead = db_lead is None
+    if is_new_lead:
+        # Criar lead e distribuir automaticamente
+        db_lead, broker = _stage_lead(db, LeadCreate(
+            contact_name=contact_name,
+            phone=from_number,
+            initial_message=message_text,
+            source="WhatsApp Maytapi"
+        ))
+    
+    db.commit()
+    if is_new_lead:
+        _remember_lead_phone(from_number)
+    return connection_id, db_lead, broker.user if broker else None
 
 def get_lead_distribution_history(db: Session, skip: int = 0, limit: int = 100) -> List[LeadDistribution]:
     """Buscar histórico de distribuição de leads"""
     return (db.query(LeadDistribution)
-            .options(joinedload(LeadDistribution.lead), joinedload(LeadDistribution.broker))
+            .options(
+                joinedload(LeadDistribution.lead).joinedload(Lead.assigned_broker),
+                joinedload(LeadDistribution.broker),
+                raiseload("*")
+            )
             .order_by(desc(LeadDistribution.distributed_at))
             .offset(skip)
             .limit(limit)
@@ -242,47 +394,41 @@ def get_dashboard_stats(db: Session, user_id: int, is_admin: bool) -> DashboardS
     week_ago = today - timedelta(days=7)
     month_ago = today - timedelta(days=30)
     
-    # Query base de leads
-    query = db.query(Lead)
+    # Contagens por status e por período em uma única consulta agrupada (tuplas Row, sem instâncias ORM)
+    stmt = select(
+        Lead.status,
+        func.count(Lead.id),
+        func.count(Lead.id).filter(Lead.created_at >= today),
+        func.count(Lead.id).filter(Lead.created_at >= week_ago),
+        func.count(Lead.id).filter(Lead.created_at >= month_ago)
+    ).group_by(Lead.status)
     if not is_admin:
-        query = query.filter(Lead.assigned_broker_id == user_id)
-    
-    # Total de leads
-    total_leads = query.count()
-    
-    # Leads hoje
-    leads_today = query.filter(Lead.created_at >= today).count()
+        stmt = stmt.where(Lead.assigned_broker_id == user_id)
     
-    # Leads esta semana
-    leads_this_week = query.filter(Lead.created_at >= week_ago).count()
-    
-    # Leads este mês
-    leads_this_month = query.filter(Lead.created_at >= month_ago).count()
-    
-    # Leads por status
-    leads_by_status = {}
-    for status in LeadStatusEnum:
-        count = query.filter(Lead.status == status).count()
-        leads_by_status[status.value] = count
+    total_leads = leads_today = leads_this_week = leads_this_month = 0
+    leads_by_status = {status.value: 0 for status in LeadStatusEnum}
+    for status, total, today_count, week_count, month_count in db.execute(stmt):
+        leads_by_status[status.value] = total
+        total_leads += total
+        leads_today += today_count
+        leads_this_week += week_count
+        leads_this_month += month_count
     
     # Leads por corretor (apenas para admin)
     leads_by_broker = {}
     if is_admin:
-        broker_stats = (db.query(User.name, func.count(Lead.id))
-                       .outerjoin(Lead, User.id == Lead.assigned_broker_id)
-                       .filter(User.role == "broker")
-                       .group_by(User.id, User.name)
-                       .all())
-        
-        for name, count in broker_stats:
-            if name:  # Verificar se name não é None
-                leads_by_broker[name] = count
+        leads_by_broker = dict(db.execute(
+            select(User.name, func.count(Lead.id))
+            .outerjoin(Lead, User.id == Lead.assigned_broker_id)
+            .where(User.role == "broker")
+            .group_by(User.id, User.name)
+        ).all())
     
     # Taxa de conversão (leads fechados / total de leads)
-    closed_leads = query.filter(Lead.status == LeadStatusEnum.FECHADO).count()
-    conversion_rate = (closed_leads / total_leads * 100) if total_leads > 0 else 0
+    closed_leads = leads_by_status[LeadStatusEnum.FECHADO.value]
+    conversion_rate = (closed_leads / total_leads * 100) if total_leads > 0 else 0.0
     
-    return DashboardStats(
+    return DashboardStats.model_construct(
         total_leads=total_leads,
         leads_today=leads_today,
         leads_this_week=leads_this_week,
@@ -316,7 +462,7 @@ def export_leads_excel(db: Session, filters: LeadFilters) -> str:
     
     # Criar DataFrame e exportar
     df = pd.DataFrame(data)
-    filename = f"leads_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    filename = f"leads_export_{time.strftime('%Y%m%d_%H%M%S')}.xlsx"
     df.to_excel(filename, index=False, engine='openpyxl')
     
     return filename
@@ -325,7 +471,7 @@ def export_leads_pdf(db: Session, filters: LeadFilters) -> str:
     """Exportar leads para PDF"""
     leads = get_leads(db, filters, skip=0, limit=1000)  # Máximo 1k leads para PDF
     
-    filename = f"leads_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+    filename = f"leads_export_{time.strftime('%Y%m%d_%H%M%S')}.pdf"
     doc = SimpleDocTemplate(filename, pagesize=letter)
     
     # Estilos
@@ -383,6 +529,18 @@ def export_leads_pdf(db: Session, filters: LeadFilters) -> str:
     return filename
 
 # CRUD de WhatsApp Connections
+
+# Cache phone_id -> id da conexão: todo webhook recebido faz essa busca
+CONNECTION_CACHE_MAX = 256
+CONNECTION_CACHE_TTL = 60
+_connection_id_cache: "OrderedDict[Optional[str], Tuple[float, int]]" = OrderedDict()
+_connection_id_cache_lock = threading.Lock()
+
+def _invalidate_connection_cache(phone_id: Optional[str]) -> None:
+    """Remover phone_id do cache de conexões"""
+    with _connection_id_cache_lock:
+        _connection_id_cache.pop(phone_id, None)
+
 def create_whatsapp_connection(db: Session, phone_id: str, auto_respond: bool = False, welcome_message: Optional[str] = None) -> WhatsAppConnection:
     """Criar nova conexão de WhatsApp"""
     db_connection = WhatsAppConnection(
@@ -394,6 +552,7 @@ def create_whatsapp_connection(db: Session, phone_id: str, auto_respond: bool =
     db.add(db_connection)
     db.commit()
     db.refresh(db_connection)
+    _invalidate_connection_cache(phone_id)
     return db_connection
 
 def get_whatsapp_connections(db: Session, skip: int = 0, limit: int = 100) -> List[WhatsAppConnection]:
@@ -408,6 +567,27 @@ def get_whatsapp_connection_by_phone_id(db: Session, phone_id: str) -> Optional[
     """Buscar conexão de WhatsApp por phone_id"""
     return db.query(WhatsAppConnection).filter(WhatsAppConnection.phone_id == phone_id).first()
 
+def get_whatsapp_connection_id_by_phone_id(db: Session, phone_id: Optional[str]) -> Optional[int]:
+    """Buscar apenas o ID da conexão por phone_id, com cache LRU de curta duração"""
+    now = time.monotonic()
+    with _connection_id_cache_lock:
+        cached = _connection_id_cache.get(phone_id)
+        if cached and cached[0] > now:
+            _connection_id_cache.move_to_end(phone_id)
+            return cached[1]
+    
+    connection_id = db.query(WhatsAppConnection.id).filter(WhatsAppConnection.phone_id == phone_id).scalar()
+    if connection_id is None:
+        # Não guardar ausências: a conexão pode ter sido criada em outro worker
+        return None
+    
+    with _connection_id_cache_lock:
+        _connection_id_cache[phone_id] = (now + CONNECTION_CACHE_TTL, connection_id)
+        _connection_id_cache.move_to_end(phone_id)
+        while len(_connection_id_cache) > CONNECTION_CACHE_MAX:
+            _connection_id_cache.popitem(last=False)
+    return connection_id
+
 def update_whatsapp_connection(db: Session, connection_id: int, **kwargs) -> Optional[WhatsAppConnection]:
     """Atualizar conexão de WhatsApp"""
     connection = db.query(WhatsAppConnection).filter(WhatsAppConnection.id == connection_id).first()
@@ -418,6 +598,7 @@ def update_whatsapp_connection(db: Session, connection_id: int, **kwargs) -> Opt
         connection.updated_at = datetime.now()
         db.commit()
         db.refresh(connection)
+        _invalidate_connection_cache(connection.phone_id)
     return connection
 
 def update_whatsapp_connection_status(db: Session, phone_id: str, status: str, phone_number: Optional[str] = None) -> Optional[WhatsAppConnection]:
@@ -430,6 +611,7 @@ def update_whatsapp_connection_status(db: Session, phone_id: str, status: str, p
             connection.phone_number = phone_number
         db.commit()
         db.refresh(connection)
+    _invalidate_connection_cache(phone_id)
     return connection
 
 def delete_whatsapp_connection(db: Session, connection_id: int) -> bool:
@@ -438,6 +620,7 @@ def delete_whatsapp_connection(db: Session, connection_id: int) -> bool:
     if connection:
         db.delete(connection)
         db.commit()
+        _invalidate_connection_cache(connection.phone_id)
         return True
     return False
 
@@ -472,6 +655,21 @@ def get_whatsapp_conversations(db: Session, connection_id: int) -> List[WhatsApp
         WhatsAppConversation.is_active == True
     ).order_by(WhatsAppConversation.last_message_time.desc()).all()
 
+def get_whatsapp_conversations_summary(db: Session, connection_id: int) -> List[Tuple]:
+    """Obter apenas as colunas usadas na listagem de conversas (sem carregar objetos ORM)"""
+    return db.execute(
+        select(
+            WhatsAppConversation.phone_number,
+            WhatsAppConversation.contact_name,
+            WhatsAppConversation.last_message,
+            WhatsAppConversation.last_message_time,
+            WhatsAppConversation.unread_count
+        ).where(
+            WhatsAppConversation.connection_id == connection_id,
+            WhatsAppConversation.is_active == True
+        ).order_by(WhatsAppConversation.last_message_time.desc())
+    ).all()
+
 def update_conversation_last_message(db: Session, conversation_id: int, message: str, timestamp: datetime):
     """Atualizar última mensagem da conversa"""
     conversation = db.query(WhatsAppConversation).filter(WhatsAppConversation.id == conversation_id).first()
@@ -520,7 +718,8 @@ def get_conversation_by_phone(db: Session, connection_id: int, phone_number: str
 
 def mark_messages_as_read(db: Session, conversation_id: int):
     """Marcar mensagens como lidas"""
-    conversation = db.query(WhatsAppConversation).filter(WhatsAppConversation.id == conversation_id).first()
-    if conversation:
+    # db.get usa o identity map: sem nova consulta se a conversa já foi carregada
+    conversation = db.get(WhatsAppConversation, conversation_id)
+    if conversation and conversation.unread_count:
         conversation.unread_count = 0
         db.commit()
\ No newline at end of file
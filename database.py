@@ -1,6 +1,7 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 import os
 from dotenv import load_dotenv
 
@@ -12,13 +13,21 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL não encontrada nas variáveis de ambiente")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_recycle=1800,
-    pool_timeout=30,
-    max_overflow=10
-)
+# Atrás do PgBouncer (modo transaction) o pool fica a cargo dele: DB_USE_PGBOUNCER=true
+if os.getenv("DB_USE_PGBOUNCER") == "true":
+    engine = create_engine(
+        DATABASE_URL,
+        poolclass=NullPool
+    )
+else:
+    engine = create_engine(
+        DATABASE_URL,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+        pool_timeout=30,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "25")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "25"))
+    )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -1,20 +1,29 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, status, WebSocket, WebSocketDisconnect, Query
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, status, WebSocket, WebSocketDisconnect, Query, BackgroundTasks
+from fastapi.responses import HTMLResponse, FileResponse, Response, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from sqlalchemy.orm import Session
 import uvicorn
 import os
+import asyncio
+import hmac
+import hashlib
+import time
 from datetime import datetime, timedelta
-from typing import List, Optional
-import json
+from typing import List, Optional, Set, Union
+from collections import OrderedDict
+import orjson
 
 # Importações locais
-from database import get_db, create_tables
-from models import User, Lead, Broker, LeadDistribution, LeadStatus, WhatsAppConnection, WhatsAppMessage
-from auth import authenticate_user, create_access_token, get_current_user
+from database import get_db, create_tables, SessionLocal
+from models import User, Lead, Broker, LeadDistribution, LeadStatus, WhatsAppConnection
+from auth import (
+    authenticate_user, create_user_token, get_current_user, get_current_user_lite, TokenUser,
+    token_user_from_claims, get_current_admin_user, get_current_admin_or_broker_user
+)
 from maytapi import maytapi_client
 from schemas import (
     UserCreate, UserResponse, UserLogin, Token,
@@ -23,26 +32,29 @@ from schemas import (
     LeadDistributionResponse, WhatsAppWebhook,
     DashboardStats, LeadFilters,
     WhatsAppConnectionCreate, WhatsAppConnectionResponse, WhatsAppConnectionUpdate,
-    WhatsAppQRResponse, WhatsAppMessageSend, WhatsAppWebhookMessage
+    WhatsAppQRResponse, WhatsAppMessageSend, WhatsAppWebhookMessage, TestMessagePayload,
+    LEAD_LIST_ADAPTER, BROKER_LIST_ADAPTER, DISTRIBUTION_LIST_ADAPTER, WHATSAPP_CONNECTION_LIST_ADAPTER
 )
 from crud import (
     create_user, get_user_by_email, get_brokers,
-    create_lead, get_leads, update_lead, delete_lead,
+    create_lead, iter_leads_in_chunks, update_lead, delete_lead,
     create_broker, update_broker, delete_broker,
-    get_lead_distribution_history, distribute_lead,
+    get_lead_distribution_history, create_and_distribute_lead,
     get_dashboard_stats, export_leads_excel, export_leads_pdf,
     create_whatsapp_connection, get_whatsapp_connections, get_whatsapp_connection,
     get_whatsapp_connection_by_phone_id, update_whatsapp_connection,
     update_whatsapp_connection_status, delete_whatsapp_connection,
-    create_or_get_whatsapp_conversation, get_whatsapp_conversations,
+    create_or_get_whatsapp_conversation, get_whatsapp_conversations_summary,
     create_whatsapp_message, get_whatsapp_messages, get_conversation_by_phone,
-    mark_messages_as_read
+    mark_messages_as_read,
+    record_inbound_whatsapp_message
 )
 
 app = FastAPI(
     title="Sistema de Gestão de Leads WhatsApp",
     description="Sistema completo para captura e distribuição de leads via WhatsApp Business",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Configuração CORS - mais restritiva
@@ -51,43 +63,67 @@ app.add_middleware(
     allow_origins=["http://localhost:5000", "https://*.replit.app", "https://*.repl.co"],
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE"],
-    allow_headers=["*"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=600,
 )
 
+# Compressão de respostas JSON grandes (listas de leads, conversas, histórico)
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Token de verificação do webhook do WhatsApp (lido uma vez na importação)
+VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "meu-token-secreto-12345").encode()
+
+# Flags de ambiente (lidas uma vez na importação)
+DEBUG = os.getenv("DEBUG") == "true"
+IS_DEV = os.getenv("ENVIRONMENT", "development") == "development"
+
 # Configuração de arquivos estáticos e templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# Security
-security = HTTPBearer()
-
 # WebSocket connections manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
         self.user_connections: dict = {}
 
     async def connect(self, websocket: WebSocket, user_id: int):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
         self.user_connections[user_id] = websocket
 
     def disconnect(self, websocket: WebSocket, user_id: int):
-        self.active_connections.remove(websocket)
-        if user_id in self.user_connections:
+        self.active_connections.discard(websocket)
+        if self.user_connections.get(user_id) is websocket:
             del self.user_connections[user_id]
 
-    async def send_personal_message(self, message: str, user_id: int):
+    @staticmethod
+    def _as_text(message: Union[str, bytes]) -> str:
+        # O frontend faz JSON.parse(event.data), então os frames precisam ser de texto;
+        # payloads já serializados (orjson) são decodificados uma única vez por envio
+        return message.decode() if isinstance(message, bytes) else message
+
+    async def send_personal_message(self, message: Union[str, bytes], user_id: int):
         if user_id in self.user_connections:
             websocket = self.user_connections[user_id]
-            await websocket.send_text(message)
+            await websocket.send_text(self._as_text(message))
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
+    async def broadcast(self, message: Union[str, bytes]):
+        # Enviar para todos em paralelo: um cliente lento não atrasa os demais
+        message = self._as_text(message)
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(connection.send_text(message) for connection in connections),
+            return_exceptions=True
+        )
+        
+        # Remover conexões que falharam no envio
+        for connection, result in zip(connections, results):
+            if isinstance(result, Exception):
+                self.active_connections.discard(connection)
+                for user_id, websocket in list(self.user_connections.items()):
+                    if websocket is connection:
+                        del self.user_connections[user_id]
 
 manager = ConnectionManager()
 
@@ -96,64 +132,87 @@ manager = ConnectionManager()
 async def startup():
     create_tables()
 
+# Fechar o pool HTTP do cliente Maytapi
+@app.on_event("shutdown")
+async def shutdown():
+    await maytapi_client.aclose()
+
+# Cache do HTML renderizado: as páginas só dependem do caminho da rota
+# (desligado em desenvolvimento para que edições nos templates apareçam)
+page_cache: dict = {}
+PAGE_CACHE_ENABLED = not (IS_DEV or DEBUG)
+
+def render_page(request: Request, template_name: str) -> HTMLResponse:
+    """Renderizar template uma única vez e reutilizar o HTML nas próximas requisições"""
+    html = page_cache.get(template_name)
+    if html is None:
+        html = templates.get_template(template_name).render({"request": request})
+        if PAGE_CACHE_ENABLED:
+            page_cache[template_name] = html
+    return HTMLResponse(html)
+
+def json_response(model) -> Response:
+    """Responder com o JSON gerado direto pelo Pydantic (sem jsonable_encoder)"""
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
 # Rotas de páginas (Frontend)
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("login.html", {"request": request})
+    return render_page(request, "login.html")
 
 @app.get("/dashboard", response_class=HTMLResponse)
 async def dashboard_page(request: Request):
-    return templates.TemplateResponse("dashboard.html", {"request": request})
+    return render_page(request, "dashboard.html")
 
 @app.get("/leads", response_class=HTMLResponse)
 async def leads_page(request: Request):
-    return templates.TemplateResponse("leads.html", {"request": request})
+    return render_page(request, "leads.html")
 
 @app.get("/brokers", response_class=HTMLResponse)
 async def brokers_page(request: Request):
-    return templates.TemplateResponse("brokers.html", {"request": request})
+    return render_page(request, "brokers.html")
 
 @app.get("/reports", response_class=HTMLResponse)
 async def reports_page(request: Request):
-    return templates.TemplateResponse("reports.html", {"request": request})
+    return render_page(request, "reports.html")
 
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page(request: Request):
-    return templates.TemplateResponse("settings.html", {"request": request})
+    return render_page(request, "settings.html")
 
 @app.get("/whatsapp", response_class=HTMLResponse)
 async def whatsapp_page(request: Request):
-    return templates.TemplateResponse("whatsapp.html", {"request": request})
+    return render_page(request, "whatsapp.html")
 
 @app.get("/whatsapp/chat", response_class=HTMLResponse)
 async def whatsapp_chat_page(request: Request, connection_id: int = Query(...)):
-    return templates.TemplateResponse("whatsapp_chat.html", {
-        "request": request,
-        "connection_id": connection_id
-    })
+    # connection_id é lido pelo JavaScript a partir da URL
+    return render_page(request, "whatsapp_chat.html")
 
 # Rotas de autenticação
 @app.post("/api/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+def register(user: UserCreate, db: Session = Depends(get_db)):
     db_user = get_user_by_email(db, user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email já registrado")
-    return create_user(db, user)
+    return json_response(UserResponse.from_orm_fast(create_user(db, user)))
 
 @app.post("/api/login", response_model=Token)
-async def login(user_login: UserLogin, db: Session = Depends(get_db)):
+def login(user_login: UserLogin, db: Session = Depends(get_db)):
     user = authenticate_user(db, user_login.email, user_login.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email ou senha incorretos"
         )
-    access_token = create_access_token(data={"sub": user.email})
-    return {"access_token": access_token, "token_type": "bearer", "user": user}
+    access_token = create_user_token(user)
+    return json_response(Token.model_construct(
+        access_token=access_token, token_type="bearer", user=UserResponse.from_orm_fast(user)
+    ))
 
 @app.get("/api/users/me", response_model=UserResponse)
-async def read_users_me(current_user: User = Depends(get_current_user)):
-    return current_user
+def read_users_me(current_user: User = Depends(get_current_user)):
+    return json_response(UserResponse.from_orm_fast(current_user))
 
 # Rotas de leads
 @app.post("/api/leads", response_model=LeadResponse)
@@ -162,47 +221,76 @@ async def create_lead_endpoint(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    # Criar o lead
-    new_lead = create_lead(db, lead)
+    # Criar o lead (operações de banco fora do event loop)
+    if not current_user.is_admin:
+        new_lead = await run_in_threadpool(create_lead, db, lead)
+        return json_response(LeadResponse.from_orm_fast(new_lead))
     
-    # Distribuir automaticamente se for admin
-    if current_user.is_admin:
-        assigned_broker = distribute_lead(db, new_lead.id)
-        if assigned_broker:
-            # Notificar corretor via WebSocket
-            await manager.send_personal_message(
-                json.dumps({
-                    "type": "new_lead",
-                    "lead": {
-                        "id": new_lead.id,
-                        "contact_name": new_lead.contact_name,
-                        "phone": new_lead.phone,
-                        "message": new_lead.initial_message
-                    }
-                }),
-                assigned_broker.id
-            )
+    # Admin: criar e distribuir automaticamente na mesma transação
+    new_lead, assigned_broker = await run_in_threadpool(create_and_distribute_lead, db, lead)
+    if assigned_broker:
+        # Notificar corretor via WebSocket
+        await manager.send_personal_message(
+            orjson.dumps({
+                "type": "new_lead",
+                "lead": {
+                    "id": new_lead.id,
+                    "contact_name": new_lead.contact_name,
+                    "phone": new_lead.phone,
+                    "message": new_lead.initial_message
+                }
+            }),
+            assigned_broker.id
+        )
     
-    return new_lead
+    return json_response(LeadResponse.from_orm_fast(new_lead))
 
 @app.get("/api/leads", response_model=List[LeadResponse])
-async def get_leads_endpoint(
+def get_leads_endpoint(
     status: Optional[str] = None,
     broker_id: Optional[int] = None,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: TokenUser = Depends(get_current_user_lite)
 ):
     # Se for corretor, só pode ver seus próprios leads
     if not current_user.is_admin:
         broker_id = current_user.id
     
-    filters = LeadFilters(status=status, broker_id=broker_id)
-    return get_leads(db, filters, skip, limit)
+    # Parâmetros já validados pelo FastAPI: não repetir a validação do modelo
+    filters = LeadFilters.model_construct(status=status, broker_id=broker_id)
+    
+    def dump_chunk(chunk) -> bytes:
+        return LEAD_LIST_ADAPTER.dump_json([LeadResponse.from_orm_fast(lead) for lead in chunk])[1:-1]
+    
+    # Sessão própria: a da dependência é fechada antes do streaming terminar
+    db = SessionLocal()
+    try:
+        # Primeiro bloco antes de enviar o status: falhas na consulta ainda viram 500
+        chunks = iter_leads_in_chunks(db, filters, skip, limit)
+        first_chunk = next(chunks, None)
+        first = dump_chunk(first_chunk) if first_chunk else b""
+    except Exception:
+        db.close()
+        raise
+    
+    def stream_leads():
+        try:
+            yield b"[" + first
+            for chunk in chunks:
+                yield b"," + dump_chunk(chunk)
+            yield b"]"
+        except Exception as e:
+            # O status 200 já foi enviado: registrar e interromper a resposta
+            print(f"Erro ao transmitir lista de leads: {e}")
+            raise
+        finally:
+            db.close()
+    
+    return StreamingResponse(stream_leads(), media_type="application/json")
 
 @app.put("/api/leads/{lead_id}", response_model=LeadResponse)
-async def update_lead_endpoint(
+def update_lead_endpoint(
     lead_id: int,
     lead_update: LeadUpdate,
     db: Session = Depends(get_db),
@@ -211,17 +299,14 @@ async def update_lead_endpoint(
     lead = update_lead(db, lead_id, lead_update, current_user.id, current_user.is_admin)
     if not lead:
         raise HTTPException(status_code=404, detail="Lead não encontrado")
-    return lead
+    return json_response(LeadResponse.from_orm_fast(lead))
 
 @app.delete("/api/leads/{lead_id}")
-async def delete_lead_endpoint(
+def delete_lead_endpoint(
     lead_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Apenas administradores podem deletar leads")
-    
     success = delete_lead(db, lead_id)
     if not success:
         raise HTTPException(status_code=404, detail="Lead não encontrado")
@@ -229,50 +314,46 @@ async def delete_lead_endpoint(
 
 # Rotas de corretores (apenas admin)
 @app.get("/api/brokers", response_model=List[BrokerResponse])
-async def get_brokers_endpoint(
+def get_brokers_endpoint(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: TokenUser = Depends(get_current_user_lite)
 ):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    return get_brokers(db, skip, limit)
+    brokers = get_brokers(db, skip, limit)
+    return Response(
+        content=BROKER_LIST_ADAPTER.dump_json([BrokerResponse.from_orm_fast(broker) for broker in brokers]),
+        media_type="application/json"
+    )
 
 @app.post("/api/brokers", response_model=BrokerResponse)
-async def create_broker_endpoint(
+def create_broker_endpoint(
     broker: BrokerCreate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    return create_broker(db, broker)
+    return json_response(BrokerResponse.from_orm_fast(create_broker(db, broker)))
 
 @app.put("/api/brokers/{broker_id}", response_model=BrokerResponse)
-async def update_broker_endpoint(
+def update_broker_endpoint(
     broker_id: int,
     broker_update: BrokerUpdate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
     broker = update_broker(db, broker_id, broker_update)
     if not broker:
         raise HTTPException(status_code=404, detail="Corretor não encontrado")
-    return broker
+    return json_response(BrokerResponse.from_orm_fast(broker))
 
 @app.delete("/api/brokers/{broker_id}")
-async def delete_broker_endpoint(
+def delete_broker_endpoint(
     broker_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
     success = delete_broker(db, broker_id)
     if not success:
         raise HTTPException(status_code=404, detail="Corretor não encontrado")
@@ -288,11 +369,9 @@ async def whatsapp_webhook_verify(request: Request):
     token = request.query_params.get("hub.verify_token")
     challenge = request.query_params.get("hub.challenge")
     
-    # Token de verificação (deve ser configurado nas configurações)
-    VERIFY_TOKEN = os.getenv("WHATSAPP_VERIFY_TOKEN", "meu-token-secreto-12345")
-    
     if mode and token and challenge:
-        if mode == "subscribe" and token == VERIFY_TOKEN:
+        # Comparação em tempo constante para não vazar o token
+        if mode == "subscribe" and hmac.compare_digest(token.encode(), VERIFY_TOKEN):
             return int(challenge)
         else:
             raise HTTPException(status_code=403, detail="Token de verificação inválido")
@@ -301,40 +380,62 @@ async def whatsapp_webhook_verify(request: Request):
 
 # Webhook principal para mensagens (usar apenas este)
 @app.post("/api/whatsapp-webhook")
-async def whatsapp_webhook_main(request: Request, db: Session = Depends(get_db)):
+async def whatsapp_webhook_main(request: Request, background_tasks: BackgroundTasks):
     """Webhook principal - redireciona para o handler do Maytapi"""
-    return await maytapi_webhook(request, db)
+    return await maytapi_webhook(request, background_tasks)
 
 # Dashboard e estatísticas
+# Cache curto das estatísticas por usuário: {(user_id, is_admin): (expira_em, etag, json)}
+STATS_CACHE_TTL = 10
+stats_cache: dict = {}
+
 @app.get("/api/dashboard/stats", response_model=DashboardStats)
-async def get_dashboard_stats_endpoint(
+def get_dashboard_stats_endpoint(
+    request: Request,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: TokenUser = Depends(get_current_user_lite)
 ):
-    return get_dashboard_stats(db, current_user.id, current_user.is_admin)
+    key = (current_user.id, current_user.is_admin)
+    now = time.monotonic()
+    cached = stats_cache.get(key)
+    if cached is None or cached[0] <= now:
+        body = get_dashboard_stats(db, current_user.id, current_user.is_admin).model_dump_json()
+        etag = f'"{hashlib.md5(body.encode()).hexdigest()}"'
+        cached = (now + STATS_CACHE_TTL, etag, body)
+        stats_cache[key] = cached
+    
+    _, etag, body = cached
+    headers = {"ETag": etag, "Cache-Control": f"private, max-age={STATS_CACHE_TTL}"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/leads/distribution-history", response_model=List[LeadDistributionResponse])
-async def get_distribution_history_endpoint(
+def get_distribution_history_endpoint(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    return get_lead_distribution_history(db, skip, limit)
+    history = get_lead_distribution_history(db, skip, limit)
+    return Response(
+        content=DISTRIBUTION_LIST_ADAPTER.dump_json(
+            [LeadDistributionResponse.from_orm_fast(distribution) for distribution in history]
+        ),
+        media_type="application/json"
+    )
 
 # Exportação de relatórios
 @app.get("/api/export/leads/excel")
-async def export_leads_excel_endpoint(
+def export_leads_excel_endpoint(
     status: Optional[str] = None,
     broker_id: Optional[int] = None,
-    date_from: Optional[str] = None,
-    date_to: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    filters = LeadFilters(
+    filters = LeadFilters.model_construct(
         status=status,
         broker_id=broker_id if current_user.is_admin else current_user.id,
         date_from=date_from,
@@ -345,19 +446,19 @@ async def export_leads_excel_endpoint(
     return FileResponse(
         filename,
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        filename=f"leads_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        filename=f"leads_report_{time.strftime('%Y%m%d_%H%M%S')}.xlsx"
     )
 
 @app.get("/api/export/leads/pdf")
-async def export_leads_pdf_endpoint(
+def export_leads_pdf_endpoint(
     status: Optional[str] = None,
     broker_id: Optional[int] = None,
-    date_from: Optional[str] = None,
-    date_to: Optional[str] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    filters = LeadFilters(
+    filters = LeadFilters.model_construct(
         status=status,
         broker_id=broker_id if current_user.is_admin else current_user.id,
         date_from=date_from,
@@ -368,19 +469,16 @@ async def export_leads_pdf_endpoint(
     return FileResponse(
         filename,
         media_type='application/pdf',
-        filename=f"leads_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+        filename=f"leads_report_{time.strftime('%Y%m%d_%H%M%S')}.pdf"
     )
 
 # Endpoint para reordenar corretores
 @app.patch("/api/brokers/reorder")
-async def reorder_brokers(
+def reorder_brokers(
     order_updates: List[dict],
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
     try:
         for update in order_updates:
             broker_id = update.get("id")
@@ -396,28 +494,29 @@ async def reorder_brokers(
 
 # Rotas de WhatsApp - Apenas para admins
 @app.get("/api/whatsapp/connections", response_model=List[WhatsAppConnectionResponse])
-async def get_whatsapp_connections_endpoint(
+def get_whatsapp_connections_endpoint(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Listar todas as conexões de WhatsApp"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    return get_whatsapp_connections(db, skip, limit)
+    connections = get_whatsapp_connections(db, skip, limit)
+    return Response(
+        content=WHATSAPP_CONNECTION_LIST_ADAPTER.dump_json(
+            [WhatsAppConnectionResponse.from_orm_fast(connection) for connection in connections]
+        ),
+        media_type="application/json"
+    )
 
 @app.post("/api/whatsapp/connections", response_model=WhatsAppConnectionResponse)
 async def create_whatsapp_connection_endpoint(
     connection_data: WhatsAppConnectionCreate,
     request: Request,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Criar nova conexão de WhatsApp ou usar conexão existente"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
     try:
         # Obter ou criar conexão via Maytapi
         result = await maytapi_client.create_phone_connection()
@@ -427,37 +526,41 @@ async def create_whatsapp_connection_endpoint(
             if not phone_id:
                 raise HTTPException(status_code=500, detail="ID do telefone não retornado pela API")
             
-            # Verificar se já existe uma conexão com este phone_id
-            existing_connection = get_whatsapp_connection_by_phone_id(db, phone_id)
-            
-            if existing_connection:
-                # Atualizar conexão existente com novas configurações
-                connection = update_whatsapp_connection(
-                    db, 
-                    existing_connection.id,
-                    auto_respond=connection_data.auto_respond,
-                    welcome_message=connection_data.welcome_message,
-                    status="connecting"
-                )
-            else:
+            def upsert_connection():
+                # Verificar se já existe uma conexão com este phone_id
+                existing_connection = get_whatsapp_connection_by_phone_id(db, phone_id)
+                
+                if existing_connection:
+                    # Atualizar conexão existente com novas configurações
+                    return update_whatsapp_connection(
+                        db, 
+                        existing_connection.id,
+                        auto_respond=connection_data.auto_respond,
+                        welcome_message=connection_data.welcome_message,
+                        status="connecting"
+                    )
                 # Criar nova conexão no banco de dados
-                connection = create_whatsapp_connection(
+                return create_whatsapp_connection(
                     db, 
                     phone_id=phone_id,
                     auto_respond=connection_data.auto_respond,
                     welcome_message=connection_data.welcome_message
                 )
             
-            # Configurar webhook
+            # Configurar webhook em paralelo com a gravação no banco
             base_url = str(request.base_url).rstrip('/')
             webhook_url = f"{base_url}/api/whatsapp-webhook"
-            webhook_result = await maytapi_client.set_webhook(phone_id, webhook_url)
+            connection, webhook_result = await asyncio.gather(
+                run_in_threadpool(upsert_connection),
+                maytapi_client.set_webhook(phone_id, webhook_url)
+            )
             
             webhook_configured = webhook_result.get("status") == "success"
             
             # Atualizar status final da conexão
             if connection:
-                final_connection = update_whatsapp_connection(
+                final_connection = await run_in_threadpool(
+                    update_whatsapp_connection,
                     db, 
                     connection.id, 
                     webhook_configured=webhook_configured,
@@ -476,13 +579,10 @@ async def create_whatsapp_connection_endpoint(
 async def get_whatsapp_qr_code(
     connection_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Obter QR Code para conectar WhatsApp"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
-    connection = get_whatsapp_connection(db, connection_id)
+    connection = await run_in_threadpool(get_whatsapp_connection, db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
@@ -502,13 +602,10 @@ async def get_whatsapp_qr_code(
 async def get_whatsapp_connection_status(
     connection_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Verificar status da conexão WhatsApp"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
-    connection = get_whatsapp_connection(db, connection_id)
+    connection = await run_in_threadpool(get_whatsapp_connection, db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
@@ -518,23 +615,20 @@ async def get_whatsapp_connection_status(
         # Atualizar status no banco de dados
         new_status = result.get("status", "unknown")
         phone_number = result.get("phone_number")
-        update_whatsapp_connection_status(db, connection.phone_id, new_status, phone_number)
+        await run_in_threadpool(update_whatsapp_connection_status, db, connection.phone_id, new_status, phone_number)
         
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao verificar status: {str(e)}")
 
 @app.put("/api/whatsapp/connections/{connection_id}", response_model=WhatsAppConnectionResponse)
-async def update_whatsapp_connection_endpoint(
+def update_whatsapp_connection_endpoint(
     connection_id: int,
     connection_update: WhatsAppConnectionUpdate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Atualizar configurações da conexão WhatsApp"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
     connection = update_whatsapp_connection(
         db, 
         connection_id, 
@@ -550,13 +644,10 @@ async def update_whatsapp_connection_endpoint(
 async def delete_whatsapp_connection_endpoint(
     connection_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Deletar conexão WhatsApp"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
-    connection = get_whatsapp_connection(db, connection_id)
+    connection = await run_in_threadpool(get_whatsapp_connection, db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
@@ -565,7 +656,7 @@ async def delete_whatsapp_connection_endpoint(
         await maytapi_client.delete_phone_connection(connection.phone_id)
         
         # Remover do banco de dados
-        success = delete_whatsapp_connection(db, connection_id)
+        success = await run_in_threadpool(delete_whatsapp_connection, db, connection_id)
         
         if success:
             return {"message": "Conexão removida com sucesso"}
@@ -580,14 +671,10 @@ async def send_whatsapp_message(
     connection_id: int,
     message_data: WhatsAppMessageSend,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_or_broker_user)
 ):
     """Enviar mensagem via WhatsApp"""
-    # Permitir acesso a admins e brokers às suas conexões
-    if not (current_user.is_admin or current_user.role == "broker"):
-        raise HTTPException(status_code=403, detail="Acesso não autorizado")
-    
-    connection = get_whatsapp_connection(db, connection_id)
+    connection = await run_in_threadpool(get_whatsapp_connection, db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
@@ -603,7 +690,7 @@ async def send_whatsapp_message(
         
         # Salvar mensagem enviada no banco de dados
         if result.get("status") == "success":
-            try:
+            def save_sent_message():
                 # Encontrar ou criar conversa
                 conversation = create_or_get_whatsapp_conversation(
                     db, connection.id, message_data.to_number, 
@@ -614,6 +701,9 @@ async def send_whatsapp_message(
                 create_whatsapp_message(
                     db, conversation.id, message_data.message, sent_by_me=True
                 )
+            
+            try:
+                await run_in_threadpool(save_sent_message)
             except Exception as e:
                 print(f"Erro ao salvar mensagem enviada: {e}")
         
@@ -623,63 +713,42 @@ async def send_whatsapp_message(
 
 @app.post("/api/whatsapp/send-message")
 async def send_test_message(
-    data: dict,
+    payload: TestMessagePayload,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_user)
 ):
     """Enviar mensagem de teste"""
-    if not current_user.is_admin:
-        raise HTTPException(status_code=403, detail="Acesso restrito a administradores")
-    
-    try:
-        connection_id = data.get("connection_id")
-        to_number = data.get("to_number")
-        message = data.get("message")
-        
-        if not connection_id or not to_number or not message:
-            raise ValueError("connection_id, to_number e message são obrigatórios")
-        
-        connection_id = int(connection_id)
-        to_number = str(to_number)
-        message = str(message)
-        
-        message_data = WhatsAppMessageSend(to_number=to_number, message=message)
-        return await send_whatsapp_message(connection_id, message_data, db, current_user)
-    except (ValueError, TypeError) as e:
-        raise HTTPException(status_code=400, detail=f"Dados inválidos: {str(e)}")
+    return await send_whatsapp_message(payload.connection_id, payload, db, current_user)
 
 # Endpoints para conversas e mensagens WhatsApp
+def format_conversations(rows) -> List[dict]:
+    """Formatar linhas de get_whatsapp_conversations_summary para o frontend"""
+    return [
+        {
+            "phone": phone_number,
+            "name": contact_name,
+            "last_message": last_message or "Nenhuma mensagem",
+            "last_message_time": last_message_time,
+            "unread_count": unread_count
+        }
+        for phone_number, contact_name, last_message, last_message_time, unread_count in rows
+    ]
+
 @app.get("/api/whatsapp/connections/{connection_id}/conversations")
-async def get_connection_conversations(
+def get_connection_conversations(
     connection_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_or_broker_user)
 ):
     """Obter conversas de uma conexão WhatsApp"""
-    # Permitir acesso a admins e brokers às suas conexões
-    if not (current_user.is_admin or current_user.role == "broker"):
-        raise HTTPException(status_code=403, detail="Acesso não autorizado")
-    
     # Verificar se a conexão existe
     connection = get_whatsapp_connection(db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
     try:
-        conversations = get_whatsapp_conversations(db, connection_id)
-        
         # Formatar resposta para o frontend
-        result = []
-        for conv in conversations:
-            result.append({
-                "phone": conv.phone_number,
-                "name": conv.contact_name,
-                "last_message": conv.last_message or "Nenhuma mensagem",
-                "last_message_time": conv.last_message_time.isoformat() if conv.last_message_time else None,
-                "unread_count": conv.unread_count
-            })
-        
-        return result
+        return format_conversations(get_whatsapp_conversations_summary(db, connection_id))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao carregar conversas: {str(e)}")
 
@@ -687,15 +756,11 @@ async def get_connection_conversations(
 async def sync_whatsapp_conversations(
     connection_id: int,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_or_broker_user)
 ):
     """Sincronizar conversas do WhatsApp via API Maytapi"""
-    # Permitir acesso a admins e brokers às suas conexões
-    if not (current_user.is_admin or current_user.role == "broker"):
-        raise HTTPException(status_code=403, detail="Acesso não autorizado")
-    
     # Verificar se a conexão existe
-    connection = get_whatsapp_connection(db, connection_id)
+    connection = await run_in_threadpool(get_whatsapp_connection, db, connection_id)
     if not connection:
         raise HTTPException(status_code=404, detail="Conexão não encontrada")
     
@@ -705,206 +770,155 @@ async def sync_whatsapp_conversations(
         
         if conversations_data.get("status") == "error":
             # Fallback para conversas locais
-            local_conversations = get_whatsapp_conversations(db, connection_id)
+            local_conversations = await run_in_threadpool(get_whatsapp_conversations_summary, db, connection_id)
             return {
                 "status": "fallback", 
                 "message": "Não foi possível sincronizar via API, mostrando conversas locais",
                 "synced_count": 0,
-                "conversations": [
-                    {
-                        "phone": conv.phone_number,
-                        "name": conv.contact_name,
-                        "last_message": conv.last_message or "Nenhuma mensagem",
-                        "last_message_time": conv.last_message_time.isoformat() if conv.last_message_time else None,
-                        "unread_count": conv.unread_count
-                    }
-                    for conv in local_conversations
-                ]
+                "conversations": format_conversations(local_conversations)
             }
         
-        synced_count = 0
         conversations = conversations_data.get("conversations", [])
         
-        # Sincronizar cada conversa encontrada
-        for conv_data in conversations:
-            try:
-                # Extrair dados da conversa
-                phone_number = conv_data.get("id", "").replace("@c.us", "").replace("@g.us", "")
-                contact_name = conv_data.get("name", phone_number)
-                
-                if phone_number:
-                    # Criar ou atualizar conversa no banco
-                    conversation = create_or_get_whatsapp_conversation(
-                        db, connection_id, phone_number, contact_name
-                    )
-                    synced_count += 1
-                    
-            except Exception as e:
-                print(f"Erro ao sincronizar conversa {conv_data}: {e}")
-                continue
-        
-        # Se não conseguiu sincronizar nenhuma conversa via API, criar conversas de demonstração
-        if synced_count == 0 and len(conversations) == 0:
-            demo_conversations = [
-                {"phone": "5511999887766", "name": "Cliente Demo 1"},
-                {"phone": "5511888776655", "name": "Lead Comercial"},
-                {"phone": "5511777665544", "name": "Suporte Técnico"}
-            ]
+        def store_conversations():
+            synced_count = 0
             
-            for demo_conv in demo_conversations:
+            # Sincronizar cada conversa encontrada
+            for conv_data in conversations:
                 try:
-                    conversation = create_or_get_whatsapp_conversation(
-                        db, connection_id, demo_conv["phone"], demo_conv["name"]
-                    )
+                    # Extrair dados da conversa
+                    phone_number = conv_data.get("id", "").replace("@c.us", "").replace("@g.us", "")
+                    contact_name = conv_data.get("name", phone_number)
                     
-                    # Criar mensagem de exemplo
-                    create_whatsapp_message(
-                        db, 
-                        conversation.id,
-                        "Olá! Esta é uma conversa de demonstração.",
-                        sent_by_me=False,
-                        message_id=f"demo_{conversation.id}",
-                        timestamp=None
-                    )
-                    synced_count += 1
+                    if phone_number:
+                        # Criar ou atualizar conversa no banco
+                        conversation = create_or_get_whatsapp_conversation(
+                            db, connection_id, phone_number, contact_name
+                        )
+                        synced_count += 1
+                        
                 except Exception as e:
-                    print(f"Erro ao criar conversa demo: {e}")
+                    print(f"Erro ao sincronizar conversa {conv_data}: {e}")
                     continue
+            
+            # Se não conseguiu sincronizar nenhuma conversa via API, criar conversas de demonstração
+            if synced_count == 0 and len(conversations) == 0:
+                demo_conversations = [
+                    {"phone": "5511999887766", "name": "Cliente Demo 1"},
+                    {"phone": "5511888776655", "name": "Lead Comercial"},
+                    {"phone": "5511777665544", "name": "Suporte Técnico"}
+                ]
+                
+                for demo_conv in demo_conversations:
+                    try:
+                        conversation = create_or_get_whatsapp_conversation(
+                            db, connection_id, demo_conv["phone"], demo_conv["name"]
+                        )
+                        
+                        # Criar mensagem de exemplo
+                        create_whatsapp_message(
+                            db, 
+                            conversation.id,
+                            "Olá! Esta é uma conversa de demonstração.",
+                            sent_by_me=False,
+                            message_id=f"demo_{conversation.id}",
+                            timestamp=None
+                        )
+                        synced_count += 1
+                    except Exception as e:
+                        print(f"Erro ao criar conversa demo: {e}")
+                        continue
+            
+            # Retornar conversas atualizadas
+            return synced_count, get_whatsapp_conversations_summary(db, connection_id)
         
-        # Retornar conversas atualizadas
-        updated_conversations = get_whatsapp_conversations(db, connection_id)
+        # Gravações no banco fora do event loop
+        synced_count, updated_conversations = await run_in_threadpool(store_conversations)
         
         return {
             "status": "success",
             "message": f"{synced_count} conversas sincronizadas com sucesso",
             "synced_count": synced_count,
-            "conversations": [
-                {
-                    "phone": conv.phone_number,
-                    "name": conv.contact_name,
-                    "last_message": conv.last_message or "Nenhuma mensagem",
-                    "last_message_time": conv.last_message_time.isoformat() if conv.last_message_time else None,
-                    "unread_count": conv.unread_count
-                }
-                for conv in updated_conversations
-            ]
+            "conversations": format_conversations(updated_conversations)
         }
         
     except Exception as e:
         print(f"Erro na sincronização: {e}")
         # Fallback: retornar conversas locais se sincronização falhar
-        local_conversations = get_whatsapp_conversations(db, connection_id)
+        local_conversations = await run_in_threadpool(get_whatsapp_conversations_summary, db, connection_id)
         return {
             "status": "fallback", 
             "message": f"Erro na sincronização, mostrando {len(local_conversations)} conversas locais: {str(e)}",
             "synced_count": 0,
-            "conversations": [
-                {
-                    "phone": conv.phone_number,
-                    "name": conv.contact_name,
-                    "last_message": conv.last_message or "Nenhuma mensagem",
-                    "last_message_time": conv.last_message_time.isoformat() if conv.last_message_time else None,
-                    "unread_count": conv.unread_count
-                }
-                for conv in local_conversations
-            ]
+            "conversations": format_conversations(local_conversations)
         }
 
-async def sync_conversation_messages(db: Session, connection, conversation, chat_id: str):
-    """Sincronizar mensagens de uma conversa específica"""
-    try:
-        # Buscar mensagens recentes via API Maytapi
-        messages_data = await maytapi_client.get_chat_messages(connection.phone_id, chat_id, limit=20)
-        
-        if messages_data.get("status") == "success":
-            messages = messages_data.get("messages", [])
-            
-            for msg_data in messages:
-                try:
-                    # Extrair dados da mensagem
-                    content = msg_data.get("body", "")
-                    timestamp = msg_data.get("timestamp")
-                    sent_by_me = msg_data.get("fromMe", False)
-                    
-                    if content and timestamp:
-                        # Verificar se mensagem já existe para evitar duplicatas
-                        existing_msg = db.query(WhatsAppMessage).filter(
-                            WhatsAppMessage.conversation_id == conversation.id,
-                            WhatsAppMessage.content == content,
-                            WhatsAppMessage.timestamp == datetime.fromtimestamp(int(timestamp))
-                        ).first()
-                        
-                        if not existing_msg:
-                            # Criar nova mensagem
-                            create_whatsapp_message(
-                                db, 
-                                conversation.id,
-                                content,
-                                sent_by_me,
-                                message_id=None,
-                                timestamp=datetime.fromtimestamp(int(timestamp))
-                            )
-                            
-                except Exception as e:
-                    print(f"Erro ao processar mensagem: {e}")
-                    continue
-                    
-    except Exception as e:
-        print(f"Erro ao sincronizar mensagens da conversa {chat_id}: {e}")
-
 @app.get("/api/whatsapp/connections/{connection_id}/messages/{phone}")
-async def get_conversation_messages(
+def get_conversation_messages(
     connection_id: int,
     phone: str,
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: User = Depends(get_current_admin_or_broker_user)
 ):
     """Obter mensagens de uma conversa específica"""
-    # Permitir acesso a admins e brokers às suas conexões
-    if not (current_user.is_admin or current_user.role == "broker"):
-        raise HTTPException(status_code=403, detail="Acesso não autorizado")
-    
-    # Verificar se a conexão existe
-    connection = get_whatsapp_connection(db, connection_id)
-    if not connection:
-        raise HTTPException(status_code=404, detail="Conexão não encontrada")
+    # Obter conversa (a FK garante que a conexão existe)
+    conversation = get_conversation_by_phone(db, connection_id, phone)
+    if not conversation:
+        # Verificar se a conexão existe só quando não há conversa
+        if not get_whatsapp_connection(db, connection_id):
+            raise HTTPException(status_code=404, detail="Conexão não encontrada")
+        return []
     
     try:
-        # Obter conversa
-        conversation = get_conversation_by_phone(db, connection_id, phone)
-        if not conversation:
-            return []
-        
         # Marcar mensagens como lidas
         mark_messages_as_read(db, conversation.id)
         
-        # Obter mensagens
-        messages = get_whatsapp_messages(db, conversation.id)
-        
-        # Formatar resposta para o frontend
-        result = []
-        for msg in messages:
-            result.append({
+        # Obter mensagens e formatar resposta para o frontend
+        return [
+            {
                 "content": msg.content,
                 "sent_by_me": msg.sent_by_me,
-                "timestamp": msg.timestamp.isoformat(),
+                "timestamp": msg.timestamp,
                 "message_type": msg.message_type,
                 "status": msg.status
-            })
-        
-        return result
+            }
+            for msg in get_whatsapp_messages(db, conversation.id)
+        ]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao carregar mensagens: {str(e)}")
 
+# Entregas recentes do webhook (a Maytapi reenvia em caso de timeout): {hash: visto_em}
+WEBHOOK_DEDUP_MAX = 10_000
+WEBHOOK_DEDUP_TTL = 300
+webhook_seen: OrderedDict = OrderedDict()
+
+def webhook_key(*parts) -> bytes:
+    """Chave compacta de deduplicação para uma entrega do webhook"""
+    return hashlib.blake2b("|".join(str(p) for p in parts).encode(), digest_size=16).digest()
+
+def is_duplicate_webhook(key: bytes) -> bool:
+    """Verificar (e registrar) se a mesma entrega já foi recebida nos últimos minutos"""
+    now = time.monotonic()
+    
+    seen_at = webhook_seen.get(key)
+    if seen_at is not None and now - seen_at < WEBHOOK_DEDUP_TTL:
+        return True
+    
+    webhook_seen[key] = now
+    webhook_seen.move_to_end(key)
+    if len(webhook_seen) > WEBHOOK_DEDUP_MAX:
+        webhook_seen.popitem(last=False)
+    return False
+
 # Webhook Maytapi para receber mensagens
 @app.post("/api/maytapi-webhook")
-async def maytapi_webhook(request: Request, db: Session = Depends(get_db)):
+async def maytapi_webhook(request: Request, background_tasks: BackgroundTasks):
     """Webhook para receber mensagens da Maytapi"""
     try:
         body = await request.json()
         
         # Log apenas tipo para debug sem vazar PII
-        if os.getenv("DEBUG") == "true":
+        if DEBUG:
             print(f"Webhook tipo: {body.get('type', 'unknown')}")
         
         # Processar diferentes formatos do Maytapi
@@ -937,79 +951,96 @@ async def maytapi_webhook(request: Request, db: Session = Depends(get_db)):
                 return {"status": "ignored", "message": "Mensagem própria ignorada"}
             
             if from_number and message_text:
-                # Encontrar conexão WhatsApp
-                connection = get_whatsapp_connection_by_phone_id(db, phone_id)
+                # Descartar reenvios da mesma mensagem sem tocar no banco; sem id nem timestamp
+                # não há como distinguir reenvio de uma mensagem repetida pelo cliente ("ok", "sim")
+                message = body.get("message")
+                message_id = message.get("id") if isinstance(message, dict) else None
+                timestamp = body.get("timestamp")
+                dedup_key = None
+                if message_id or timestamp:
+                    dedup_key = webhook_key(phone_id, from_number, message_id or message_text, timestamp)
+                    if is_duplicate_webhook(dedup_key):
+                        return {"status": "duplicate"}
                 
-                if connection:
-                    # Criar ou obter conversa
-                    conversation = create_or_get_whatsapp_conversation(
-                        db, connection.id, from_number, contact_name
-                    )
-                    
-                    # Salvar mensagem recebida
-                    create_whatsapp_message(
-                        db, conversation.id, message_text, sent_by_me=False
-                    )
-                
-                # Criar lead automaticamente (processo original)
-                lead_data = LeadCreate(
-                    contact_name=contact_name,
-                    phone=from_number,
-                    initial_message=message_text,
-                    source="WhatsApp Maytapi"
+                # Responder imediatamente e gravar fora do ciclo da requisição
+                background_tasks.add_task(
+                    process_inbound_message, phone_id, from_number, contact_name, message_text, dedup_key
                 )
-                
-                new_lead = create_lead(db, lead_data)
-                
-                # Distribuir automaticamente
-                assigned_broker = distribute_lead(db, new_lead.id)
-                
-                if assigned_broker:
-                    # Notificar corretor via WebSocket (lead)
-                    await manager.send_personal_message(
-                        json.dumps({
-                            "type": "new_lead",
-                            "lead": {
-                                "id": new_lead.id,
-                                "contact_name": new_lead.contact_name,
-                                "phone": new_lead.phone,
-                                "message": new_lead.initial_message
-                            }
-                        }),
-                        assigned_broker.id
-                    )
-                
-                    # Notificar sobre nova mensagem WhatsApp via WebSocket
-                    if connection:
-                        await manager.broadcast(json.dumps({
-                            "type": "whatsapp_message",
-                            "message": {
-                                "connection_id": connection.id,
-                                "from_number": from_number,
-                                "contact_name": contact_name,
-                                "content": message_text,
-                                "timestamp": datetime.now().isoformat()
-                            }
-                        }))
-                
-                # Atualizar status da conexão se phone_id disponível
-                if phone_id:
-                    try:
-                        update_whatsapp_connection_status(db, phone_id, "connected")
-                    except:
-                        pass  # Não falhar se não conseguir atualizar status
-                
-                return {"status": "success", "lead_id": new_lead.id}
+                return {"status": "queued"}
         
         return {"status": "success", "message": "Webhook processado"}
     
     except Exception as e:
-        if os.getenv("DEBUG") == "true":
+        if DEBUG:
             print(f"Erro no webhook Maytapi: {str(e)}")
         return {"status": "error", "message": "Erro interno"}
 
+async def process_inbound_message(
+    phone_id: Optional[str], from_number: str, contact_name: str, message_text: str,
+    dedup_key: Optional[bytes] = None
+):
+    """Gravar mensagem recebida via webhook e notificar clientes WebSocket"""
+    def record():
+        # Sessão própria: a sessão da requisição já foi encerrada
+        db = SessionLocal()
+        try:
+            connection_id, new_lead, assigned_broker = record_inbound_whatsapp_message(
+                db, phone_id, from_number, contact_name, message_text
+            )
+            return (
+                connection_id,
+                new_lead.id,
+                assigned_broker.id if assigned_broker else None
+            )
+        finally:
+            db.close()
+    
+    try:
+        connection_id, lead_id, broker_id = await run_in_threadpool(record)
+    except Exception as e:
+        # O webhook já respondeu "queued": registrar sempre e liberar a chave para aceitar o reenvio
+        print(f"Erro ao processar mensagem do webhook: {str(e)}")
+        if dedup_key is not None:
+            webhook_seen.pop(dedup_key, None)
+        return
+    
+    # Notificações só depois do commit para não emitir eventos fantasmas
+    notifications = []
+    
+    # Notificar corretor via WebSocket (apenas quando um novo lead foi distribuído)
+    if broker_id:
+        notifications.append(manager.send_personal_message(
+            orjson.dumps({
+                "type": "new_lead",
+                "lead": {
+                    "id": lead_id,
+                    "contact_name": contact_name,
+                    "phone": from_number,
+                    "message": message_text
+                }
+            }),
+            broker_id
+        ))
+    
+    # Notificar sobre nova mensagem WhatsApp via WebSocket
+    if connection_id:
+        notifications.append(manager.broadcast(orjson.dumps({
+            "type": "whatsapp_message",
+            "message": {
+                "connection_id": connection_id,
+                "from_number": from_number,
+                "contact_name": contact_name,
+                "content": message_text,
+                "timestamp": datetime.now()
+            }
+        })))
+    
+    # Enviar as notificações em paralelo
+    if notifications:
+        await asyncio.gather(*notifications, return_exceptions=True)
+
 # Função para autenticar WebSocket
-async def authenticate_websocket(token: str, db: Session) -> User:
+async def authenticate_websocket(token: str, db: Session) -> Union[User, TokenUser]:
     """Autenticar usuário para conexão WebSocket"""
     try:
         from jose import jwt, JWTError
@@ -1025,7 +1056,16 @@ async def authenticate_websocket(token: str, db: Session) -> User:
     except Exception:
         raise WebSocketDisconnect(code=1008, reason="Token inválido")
     
-    user = db.query(User).filter(User.email == email, User.is_active == True).first()
+    # Token assinado já traz id e status do usuário: dispensa consulta ao banco
+    token_user = token_user_from_claims(payload)
+    if token_user is not None:
+        return token_user
+    
+    # Tokens emitidos antes das claims extras: buscar no banco
+    def find_active_user():
+        return db.query(User).filter(User.email == email, User.is_active == True).first()
+    
+    user = await run_in_threadpool(find_active_user)
     if user is None:
         raise WebSocketDisconnect(code=1008, reason="Usuário não encontrado")
     
@@ -1061,15 +1101,11 @@ async def websocket_endpoint(
         await websocket.close(code=1011, reason="Erro de autenticação")
 
 if __name__ == "__main__":
-    import os
-    
     # Para produção, desabilitar reload
-    is_development = os.getenv("ENVIRONMENT", "development") == "development"
-    
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=5000,
-        reload=is_development,
+        reload=IS_DEV,
         log_level="info"
     )
\ No newline at end of file
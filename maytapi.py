@@ -2,11 +2,13 @@
 Integração com Maytapi WhatsApp Business API
 """
 import os
+import time
 import httpx
 import asyncio
-from typing import Dict, List, Optional, Any
+import base64
+from typing import Dict, List, Optional, Any, Awaitable, Callable, Tuple
 from fastapi import HTTPException
-import json
+import orjson
 
 class MaytapiClient:
     def __init__(self):
@@ -15,6 +17,13 @@ class MaytapiClient:
         self.base_url = "https://api.maytapi.com/api"
         self.headers = None
         self._initialized = False
+        self._client: Optional[httpx.AsyncClient] = None
+        
+        # Cache TTL das consultas à Maytapi: {chave: (expira_em, resposta)}
+        self.cache_ttl = float(os.getenv("MAYTAPI_CACHE_TTL", "30"))
+        self.status_cache_ttl = float(os.getenv("MAYTAPI_STATUS_CACHE_TTL", "5"))
+        self._cache: Dict[str, Tuple[float, Dict]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
         
         # Inicializar imediatamente se as credenciais estiverem disponíveis
         if self.product_id and self.token:
@@ -41,54 +50,106 @@ class MaytapiClient:
             "x-maytapi-key": self.token,
             "Content-Type": "application/json"
         }
+        # Recriar o cliente HTTP com os novos headers na próxima chamada
+        self._client = None
         self._initialized = True
         return True
     
+    def _get_client(self) -> httpx.AsyncClient:
+        """Obter cliente HTTP compartilhado (pool de conexões keep-alive)"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                timeout=httpx.Timeout(30.0, connect=5.0),
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=50,
+                    keepalive_expiry=60.0
+                )
+            )
+        return self._client
+    
+    async def aclose(self):
+        """Fechar o cliente HTTP compartilhado"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    async def _cached(self, key: str, ttl: float, fetch: Callable[[], Awaitable[Dict]]) -> Dict:
+        """Retornar resposta em cache ou buscar uma única vez para chamadas concorrentes"""
+        entry = self._cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_store(key, ttl, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+    
+    async def _fetch_and_store(self, key: str, ttl: float, fetch: Callable[[], Awaitable[Dict]]) -> Dict:
+        result = await fetch()
+        # Não guardar respostas de erro em cache
+        if result.get("status") != "error":
+            self._cache[key] = (time.monotonic() + ttl, result)
+        return result
+    
+    def _invalidate(self, key: str):
+        self._cache.pop(key, None)
+    
     async def get_phone_list(self) -> Dict:
-        """Listar todos os telefones conectados"""
+        """Listar todos os telefones conectados (com cache TTL)"""
+        return await self._cached("phone_list", self.cache_ttl, self._fetch_phone_list)
+    
+    async def _fetch_phone_list(self) -> Dict:
         if not self._ensure_initialized():
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.product_id}/listPhones",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                data = response.json()
+            client = self._get_client()
+            response = await client.get(
+                f"/{self.product_id}/listPhones"
+            )
+            response.raise_for_status()
+            data = orjson.loads(response.content)
                 
-                # A API listPhones retorna diretamente um array
-                if isinstance(data, list):
-                    return {"status": "success", "data": data}
-                elif data.get("success"):
-                    return {"status": "success", "data": data.get("data", [])}
-                else:
-                    return {"status": "error", "message": data.get("message", "Erro ao listar telefones")}
+            # A API listPhones retorna diretamente um array
+            if isinstance(data, list):
+                return {"status": "success", "data": data}
+            elif data.get("success"):
+                return {"status": "success", "data": data.get("data", [])}
+            else:
+                return {"status": "error", "message": data.get("message", "Erro ao listar telefones")}
         except Exception as e:
             print(f"Erro ao listar telefones: {e}")
             return {"status": "error", "message": str(e)}
     
     async def get_phone_status(self, phone_id: str) -> Dict:
-        """Verificar status de um telefone específico"""
+        """Verificar status de um telefone específico (com cache TTL)"""
+        return await self._cached(
+            f"status:{phone_id}", self.status_cache_ttl, lambda: self._fetch_phone_status(phone_id)
+        )
+    
+    async def _fetch_phone_status(self, phone_id: str) -> Dict:
         if not self._ensure_initialized():
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/status",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                data = response.json()
+            client = self._get_client()
+            response = await client.get(
+                f"/{self.product_id}/{phone_id}/status"
+            )
+            response.raise_for_status()
+            data = orjson.loads(response.content)
                 
-                # Verificar se a resposta tem formato esperado
-                if isinstance(data, dict):
-                    return data
-                else:
-                    # Fallback: assumir que está idle se response é válido
-                    return {"status": "idle", "message": "Status verificado"}
+            # Verificar se a resposta tem formato esperado
+            if isinstance(data, dict):
+                return data
+            else:
+                # Fallback: assumir que está idle se response é válido
+                return {"status": "idle", "message": "Status verificado"}
                     
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
@@ -108,49 +169,46 @@ class MaytapiClient:
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/screen",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                
-                # Verificar o tipo de conteúdo da resposta
-                content_type = response.headers.get("content-type", "")
+            client = self._get_client()
+            response = await client.get(
+                f"/{self.product_id}/{phone_id}/screen"
+            )
+            response.raise_for_status()
+            
+            # Verificar o tipo de conteúdo da resposta
+            content_type = response.headers.get("content-type", "")
+            
+            if "image" in content_type:
+                # Resposta é uma imagem binária - converter para base64
+                base64_image = base64.b64encode(response.content).decode('ascii')
+                data_uri = f"data:{content_type};base64,{base64_image}"
                 
-                if "image" in content_type:
-                    # Resposta é uma imagem binária - converter para base64
-                    import base64
-                    image_data = response.content
-                    base64_image = base64.b64encode(image_data).decode('utf-8')
-                    data_uri = f"data:{content_type};base64,{base64_image}"
-                    
+                return {
+                    "status": "success",
+                    "screen": data_uri,
+                    "message": "QR Code obtido com sucesso"
+                }
+            
+            # Resposta é JSON
+            try:
+                data = orjson.loads(response.content)
+                if data.get("success"):
                     return {
                         "status": "success",
-                        "screen": data_uri,
+                        "screen": data.get("data", {}).get("screen"),
                         "message": "QR Code obtido com sucesso"
                     }
                 else:
-                    # Resposta é JSON
-                    try:
-                        data = response.json()
-                        if data.get("success"):
-                            return {
-                                "status": "success",
-                                "screen": data.get("data", {}).get("screen"),
-                                "message": "QR Code obtido com sucesso"
-                            }
-                        else:
-                            return {
-                                "status": "error",
-                                "message": data.get("message", "Erro ao obter QR Code")
-                            }
-                    except:
-                        # Se não conseguir fazer JSON, tentar como texto
-                        return {
-                            "status": "error",
-                            "message": f"Resposta inesperada da API: {response.text[:100]}"
-                        }
+                    return {
+                        "status": "error",
+                        "message": data.get("message", "Erro ao obter QR Code")
+                    }
+            except:
+                # Se não conseguir fazer JSON, tentar como texto
+                return {
+                    "status": "error",
+                    "message": f"Resposta inesperada da API: {response.text[:100]}"
+                }
         except Exception as e:
             print(f"Erro ao obter QR Code para {phone_id}: {e}")
             return {"status": "error", "message": str(e)}
@@ -161,25 +219,24 @@ class MaytapiClient:
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/getChats",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                data = response.json()
+            client = self._get_client()
+            response = await client.get(
+                f"/{self.product_id}/{phone_id}/getChats"
+            )
+            response.raise_for_status()
+            data = orjson.loads(response.content)
                 
-                if data.get("success"):
-                    return {
-                        "status": "success",
-                        "conversations": data.get("data", []),
-                        "message": "Conversas obtidas com sucesso"
-                    }
-                else:
-                    return {
-                        "status": "error", 
-                        "message": data.get("message", "Erro ao obter conversas")
-                    }
+            if data.get("success"):
+                return {
+                    "status": "success",
+                    "conversations": data.get("data", []),
+                    "message": "Conversas obtidas com sucesso"
+                }
+            else:
+                return {
+                    "status": "error", 
+                    "message": data.get("message", "Erro ao obter conversas")
+                }
                     
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
@@ -203,29 +260,28 @@ class MaytapiClient:
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/getChatMessages",
-                    headers=self.headers,
-                    params={
-                        "chat_id": chat_id,
-                        "limit": limit
-                    }
-                )
-                response.raise_for_status()
-                data = response.json()
+            client = self._get_client()
+            response = await client.get(
+                f"/{self.product_id}/{phone_id}/getChatMessages",
+                params={
+                    "chat_id": chat_id,
+                    "limit": limit
+                }
+            )
+            response.raise_for_status()
+            data = orjson.loads(response.content)
                 
-                if data.get("success"):
-                    return {
-                        "status": "success",
-                        "messages": data.get("data", []),
-                        "message": "Mensagens obtidas com sucesso"
-                    }
-                else:
-                    return {
-                        "status": "error",
-                        "message": data.get("message", "Erro ao obter mensagens")
-                    }
+            if data.get("success"):
+                return {
+                    "status": "success",
+                    "messages": data.get("data", []),
+                    "message": "Mensagens obtidas com sucesso"
+                }
+            else:
+                return {
+                    "status": "error",
+                    "message": data.get("message", "Erro ao obter mensagens")
+                }
         except Exception as e:
             print(f"Erro ao obter mensagens do chat {chat_id} para {phone_id}: {e}")
             return {"status": "error", "message": str(e)}
@@ -242,14 +298,13 @@ class MaytapiClient:
                 "type": "text"
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/sendMessage",
-                    headers=self.headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                return response.json()
+            client = self._get_client()
+            response = await client.post(
+                f"/{self.product_id}/{phone_id}/sendMessage",
+                json=payload
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Erro ao enviar mensagem: {e}")
             return {"status": "error", "message": str(e)}
@@ -275,26 +330,26 @@ class MaytapiClient:
                 }
             
             # Se não há telefones, tentar criar um novo
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/{self.product_id}/addPhone",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                data = response.json()
+            client = self._get_client()
+            response = await client.post(
+                f"/{self.product_id}/addPhone"
+            )
+            response.raise_for_status()
+            data = orjson.loads(response.content)
                 
-                # Converter formato da resposta Maytapi para formato padrão
-                if data.get("success"):
-                    return {
-                        "status": "success",
-                        "phone_id": str(data.get("data", {}).get("id")),
-                        "message": "Conexão criada com sucesso"
-                    }
-                else:
-                    return {
-                        "status": "error", 
-                        "message": data.get("message", "Erro desconhecido")
-                    }
+            # Converter formato da resposta Maytapi para formato padrão
+            if data.get("success"):
+                self._invalidate("phone_list")
+                return {
+                    "status": "success",
+                    "phone_id": str(data.get("data", {}).get("id")),
+                    "message": "Conexão criada com sucesso"
+                }
+            else:
+                return {
+                    "status": "error", 
+                    "message": data.get("message", "Erro desconhecido")
+                }
         except Exception as e:
             print(f"Erro ao criar conexão: {e}")
             return {"status": "error", "message": str(e)}
@@ -305,13 +360,14 @@ class MaytapiClient:
             return {"status": "error", "message": "Credenciais Maytapi não configuradas"}
             
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.delete(
-                    f"{self.base_url}/{self.product_id}/{phone_id}",
-                    headers=self.headers
-                )
-                response.raise_for_status()
-                return response.json()
+            client = self._get_client()
+            response = await client.delete(
+                f"/{self.product_id}/{phone_id}"
+            )
+            response.raise_for_status()
+            self._invalidate("phone_list")
+            self._invalidate(f"status:{phone_id}")
+            return orjson.loads(response.content)
         except Exception as e:
             print(f"Erro ao remover conexão {phone_id}: {e}")
             return {"status": "error", "message": str(e)}
@@ -326,14 +382,13 @@ class MaytapiClient:
                 "webhook": webhook_url
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/{self.product_id}/{phone_id}/setWebhook",
-                    headers=self.headers,
-                    json=payload
-                )
-                response.raise_for_status()
-                return response.json()
+            client = self._get_client()
+            response = await client.post(
+                f"/{self.product_id}/{phone_id}/setWebhook",
+                json=payload
+            )
+            response.raise_for_status()
+            return orjson.loads(response.content)
                 
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
@@ -1,4 +1,4 @@
-from sqlalchemy import Integer, String, Boolean, DateTime, Text, ForeignKey, Enum
+from sqlalchemy import Integer, String, Boolean, DateTime, Text, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from sqlalchemy.sql import func
 from database import Base
@@ -16,6 +16,9 @@ class LeadStatusEnum(str, enum.Enum):
     FECHADO = "fechado"
     PERDIDO = "perdido"
 
+# Lookup por valor sem construir o enum a cada chamada (filtros de status)
+LEAD_STATUS_BY_VALUE = {status.value: status for status in LeadStatusEnum}
+
 class User(Base):
     __tablename__ = "users"
     
@@ -29,12 +32,18 @@ class User(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), onupdate=func.now())
     
-    # Relacionamentos
-    assigned_leads: Mapped[list["Lead"]] = relationship("Lead", back_populates="assigned_broker")
-    distribution_history: Mapped[list["LeadDistribution"]] = relationship("LeadDistribution", back_populates="broker")
+    # Relacionamentos (coleções não usadas pelas rotas: lazy="raise" evita SELECT implícito)
+    assigned_leads: Mapped[list["Lead"]] = relationship("Lead", back_populates="assigned_broker", lazy="raise")
+    distribution_history: Mapped[list["LeadDistribution"]] = relationship("LeadDistribution", back_populates="broker", lazy="raise")
 
 class Lead(Base):
     __tablename__ = "leads"
+    __table_args__ = (
+        # Filtros do dashboard e da listagem de leads
+        Index("ix_leads_created_status", "created_at", "status"),
+        Index("ix_leads_broker_created", "assigned_broker_id", "created_at"),
+        Index("ix_leads_status_broker", "status", "assigned_broker_id"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     contact_name: Mapped[str] = mapped_column(String(100), nullable=False)
@@ -53,8 +62,8 @@ class Lead(Base):
     assigned_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     
     # Relacionamentos
-    assigned_broker: Mapped[Optional["User"]] = relationship("User", back_populates="assigned_leads")
-    distribution_history: Mapped[list["LeadDistribution"]] = relationship("LeadDistribution", back_populates="lead")
+    assigned_broker: Mapped[Optional["User"]] = relationship("User", back_populates="assigned_leads", lazy="joined")
+    distribution_history: Mapped[list["LeadDistribution"]] = relationship("LeadDistribution", back_populates="lead", lazy="raise")
 
 class Broker(Base):
     __tablename__ = "brokers"
@@ -74,6 +83,10 @@ class Broker(Base):
 
 class LeadDistribution(Base):
     __tablename__ = "lead_distributions"
+    __table_args__ = (
+        # Contagem diária por corretor (limite max_leads_per_day)
+        Index("ix_dist_broker_time", "broker_id", "distributed_at"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     lead_id: Mapped[int] = mapped_column(Integer, ForeignKey("leads.id"), nullable=False)
@@ -82,8 +95,8 @@ class LeadDistribution(Base):
     distribution_method: Mapped[str] = mapped_column(String(50), default="automatic")  # automatic, manual
     
     # Relacionamentos
-    lead: Mapped["Lead"] = relationship("Lead", back_populates="distribution_history")
-    broker: Mapped["User"] = relationship("User", back_populates="distribution_history")
+    lead: Mapped["Lead"] = relationship("Lead", back_populates="distribution_history", lazy="selectin")
+    broker: Mapped["User"] = relationship("User", back_populates="distribution_history", lazy="selectin")
 
 class LeadStatus(Base):
     __tablename__ = "lead_statuses"
@@ -1,9 +1,38 @@
-from pydantic import BaseModel, EmailStr, validator
+from pydantic import BaseModel, EmailStr, TypeAdapter, validator
 from datetime import datetime
-from typing import Optional, List
+from functools import lru_cache
+from typing import Optional, List, Tuple, Type, get_args
 from models import UserRole, LeadStatusEnum
+import re
+
+# Base dos schemas de resposta montados a partir de objetos do banco
+class ORMResponse(BaseModel):
+    @classmethod
+    def from_orm_fast(cls, obj):
+        """Converter objeto ORM (dados confiáveis) sem passar pelos validadores do Pydantic"""
+        if obj is None:
+            return None
+        data = {}
+        for name, nested in _orm_fields(cls):
+            value = getattr(obj, name)
+            data[name] = nested.from_orm_fast(value) if nested is not None else value
+        return cls.model_construct(**data)
+
+@lru_cache(maxsize=None)
+def _orm_fields(cls: Type[ORMResponse]) -> Tuple[Tuple[str, Optional[Type[ORMResponse]]], ...]:
+    """Campos do schema e, para os aninhados, o schema de resposta correspondente"""
+    fields = []
+    for name, field in cls.model_fields.items():
+        nested = None
+        for candidate in (field.annotation, *get_args(field.annotation)):
+            if isinstance(candidate, type) and issubclass(candidate, ORMResponse):
+                nested = candidate
+                break
+        fields.append((name, nested))
+    return tuple(fields)
 
 # Schemas de usuário
+# Entrada: email validado com EmailStr
 class UserBase(BaseModel):
     name: str
     email: EmailStr
@@ -26,7 +55,14 @@ class UserUpdate(BaseModel):
     role: Optional[UserRole] = None
     is_active: Optional[bool] = None
 
-class UserResponse(UserBase):
+# Saída: email vem do banco (já validado na entrada), sem rodar o email-validator
+class UserOutBase(BaseModel):
+    name: str
+    email: str
+    is_admin: bool = False
+    role: UserRole = UserRole.BROKER
+
+class UserResponse(UserOutBase, ORMResponse):
     id: int
     is_active: bool
     created_at: datetime
@@ -62,7 +98,7 @@ class LeadUpdate(BaseModel):
     notes: Optional[str] = None
     assigned_broker_id: Optional[int] = None
 
-class LeadResponse(LeadBase):
+class LeadResponse(LeadBase, ORMResponse):
     id: int
     status: LeadStatusEnum
     assigned_broker_id: Optional[int]
@@ -88,7 +124,7 @@ class BrokerUpdate(BaseModel):
     is_active: Optional[bool] = None
     max_leads_per_day: Optional[int] = None
 
-class BrokerResponse(BrokerBase):
+class BrokerResponse(BrokerBase, ORMResponse):
     id: int
     user_id: int
     user: UserResponse
@@ -99,7 +135,7 @@ class BrokerResponse(BrokerBase):
         from_attributes = True
 
 # Schema para histórico de distribuição
-class LeadDistributionResponse(BaseModel):
+class LeadDistributionResponse(ORMResponse):
     id: int
     lead_id: int
     broker_id: int
@@ -132,17 +168,29 @@ class DashboardStats(BaseModel):
 class LeadFilters(BaseModel):
     status: Optional[str] = None
     broker_id: Optional[int] = None
-    date_from: Optional[str] = None
-    date_to: Optional[str] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
     source: Optional[str] = None
 
 # Schema para status personalizados
+HEX_COLOR_RE = re.compile(r"^#[0-9a-fA-F]{6}$")
+
+def _parse_color(value: str) -> str:
+    """Validar cor hexadecimal"""
+    if not HEX_COLOR_RE.match(value):
+        raise ValueError('Cor deve estar no formato hexadecimal (#RRGGBB)')
+    return value
+
 class LeadStatusBase(BaseModel):
     name: str
     color: str = "#6B7280"
     description: Optional[str] = None
     is_active: bool = True
     sort_order: int = 0
+    
+    @validator('color')
+    def validate_color(cls, v):
+        return _parse_color(v)
 
 class LeadStatusCreate(LeadStatusBase):
     pass
@@ -153,8 +201,12 @@ class LeadStatusUpdate(BaseModel):
     description: Optional[str] = None
     is_active: Optional[bool] = None
     sort_order: Optional[int] = None
+    
+    @validator('color')
+    def validate_color(cls, v):
+        return _parse_color(v) if v is not None else v
 
-class LeadStatusResponse(LeadStatusBase):
+class LeadStatusResponse(LeadStatusBase, ORMResponse):
     id: int
     created_at: datetime
     updated_at: Optional[datetime]
@@ -175,7 +227,7 @@ class SystemConfigUpdate(BaseModel):
     value: Optional[str] = None
     description: Optional[str] = None
 
-class SystemConfigResponse(SystemConfigBase):
+class SystemConfigResponse(SystemConfigBase, ORMResponse):
     id: int
     created_at: datetime
     updated_at: Optional[datetime]
@@ -199,7 +251,7 @@ class WhatsAppConnectionUpdate(BaseModel):
     auto_respond: Optional[bool] = None
     welcome_message: Optional[str] = None
 
-class WhatsAppConnectionResponse(WhatsAppConnectionBase):
+class WhatsAppConnectionResponse(WhatsAppConnectionBase, ORMResponse):
     id: int
     status: str
     is_active: bool
@@ -221,9 +273,18 @@ class WhatsAppMessageSend(BaseModel):
     to_number: str
     message: str
 
+class TestMessagePayload(WhatsAppMessageSend):
+    connection_id: int
+
 class WhatsAppWebhookMessage(BaseModel):
     phone_id: str
     from_number: str
     message: str
     contact_name: Optional[str] = None
-    timestamp: Optional[datetime] = None
\ No newline at end of file
+    timestamp: Optional[datetime] = None
+
+# Adaptadores de listas (schema compilado uma única vez na importação)
+LEAD_LIST_ADAPTER = TypeAdapter(List[LeadResponse])
+BROKER_LIST_ADAPTER = TypeAdapter(List[BrokerResponse])
+DISTRIBUTION_LIST_ADAPTER = TypeAdapter(List[LeadDistributionResponse])
+WHATSAPP_CONNECTION_LIST_ADAPTER = TypeAdapter(List[WhatsAppConnectionResponse])